@@ -1,38 +1,224 @@
 # Serial read test for P1 Port
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dataclasses import dataclass, fields, replace
+from urllib.parse import urlparse, parse_qs
+from collections import deque
 from tabulate import tabulate
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import crcmod.predefined
+import ctypes.util
+import dataclasses
 import traceback
+import threading
+import cProfile
+import ctypes
+import pstats
 import requests
 import serial
 import json
 import uuid
+import gzip
+import zlib
+import struct
+import signal
+import time
+import sys
 import re
 import os
 
-# usb0 is used for connection with meter
-PORT = "/dev/ttyUSB0"
 
-# Meter baud rate is 115200 (bit/s)
-BAUD_RATE = 115200
+# All settings, loaded from a JSON file and P1_<SETTING> environment variables
+@dataclass
+class Config:
+    # usb0 is used for connection with meter
+    port: str = "/dev/ttyUSB0"
 
-# Debug mode
-DEBUG = False
-PI_KEY = ""
+    # Meter baud rate is 115200 (bit/s)
+    baudRate: int = 115200
 
-LOGIN_URL = 'https://meterapiproject4.azurewebsites.net/api/User/login'
-SEND_URL = 'https://meterapiproject4.azurewebsites.net/api/MeterData'
-GET_USER_METERS = 'https://meterapiproject4.azurewebsites.net/api/UserMeter'
-GET_SEND_METERS = 'https://meterapiproject4.azurewebsites.net/api/Meter'
-SEND_DATA = True
-METER_ID = -1
-METER_ID_DB = -1
+    # Debug mode
+    debug: bool = False
 
+    loginUrl: str = 'https://meterapiproject4.azurewebsites.net/api/User/login'
+    sendUrl: str = 'https://meterapiproject4.azurewebsites.net/api/MeterData'
+    getUserMetersUrl: str = 'https://meterapiproject4.azurewebsites.net/api/UserMeter'
+    getSendMetersUrl: str = 'https://meterapiproject4.azurewebsites.net/api/Meter'
+    sendData: bool = True
 
-# API LOGIN CREDENTIALS
-API_USERNAME = "elek3city@outlook.com"
-API_PW = "raspberry1234"
-API_TOKEN = ""
+    # API LOGIN CREDENTIALS, set in config file or P1_API_USERNAME / P1_API_PASSWORD
+    apiUsername: str = ""
+    apiPassword: str = ""
+
+    # File with the unique key of this PI
+    keyFile: str = "uuid.key"
+
+    # Amount of telegrams to process before the program stops, 0 keeps running
+    dataQuantity: int = 1
+
+    # Only process every n-th valid telegram
+    sampleEvery: int = 1
+
+    # Upload wire format: "identity" (plain JSON), "gzip" or "deflate"
+    uploadEncoding: str = "identity"
+
+    # Amount of readings collected before uploading, > 1 sends a columnar batch
+    batchSize: int = 1
+
+    # Upload OBIS_FOR_SEND_EXTRA fields as well
+    sendExtraData: bool = False
+
+    # Extra payload fields: {"field name": "OBIS code"}, e.g. {"voltageL1": "1-0:32.7.0"}
+    sendSchema: dict = dataclasses.field(default_factory=dict)
+
+    # Local API serving recent telegrams, only on this machine unless host is changed
+    localApi: bool = False
+    localApiHost: str = "127.0.0.1"
+    localApiPort: int = 8080
+
+    # Origin allowed to read the local API from a browser, e.g. "http://dashboard.local"
+    localApiCorsOrigin: str = ""
+
+    # Amount of recent telegrams kept in memory
+    ringSize: int = 360
+
+    # Keep running energy totals per tariff, quarter-hour peaks and gas per hour
+    aggregateData: bool = False
+
+    # Upload hourly rollups instead of every reading (requires aggregateData)
+    uploadRollups: bool = False
+    rollupUrl: str = 'https://meterapiproject4.azurewebsites.net/api/MeterRollup'
+
+    # Aggregator state is saved here, so a restart continues where it stopped
+    checkpointFile: str = "aggregate.json"
+
+    # Amount of telegrams between checkpoints
+    checkpointInterval: int = 30
+
+    # Write duration of every stage per telegram to traceFile
+    trace: bool = False
+    traceFile: str = "trace.bin"
+
+    # Profile main loop: "" (off), "cprofile" or "sampling"
+    profile: str = ""
+    profileFile: str = "mainLoop.prof"
+
+    # Read settings from file (if it exists), environment overrides the file
+    @classmethod
+    def load(cls, path=None):
+        values = {}
+
+        if path is not None and os.path.exists(path):
+            with open(path) as configFile:
+                values = json.load(configFile)
+
+        settings = {}
+        for setting in fields(cls):
+            # baudRate is set with P1_BAUD_RATE
+            envName = "P1_" + re.sub(r'([A-Z])', r'_\1', setting.name).upper()
+            value = os.environ.get(envName, values.pop(setting.name, None))
+
+            if value is not None:
+                settings[setting.name] = convertSetting(setting.type, value)
+
+        for name in values:
+            print(f"Unknown setting in {path}: {name}\n")
+
+        return cls(**settings)
+
+    # Reject invalid settings, a bad reload then keeps the current config
+    def __post_init__(self):
+        if self.uploadEncoding not in UPLOAD_ENCODINGS:
+            raise ValueError(
+                f"uploadEncoding must be one of {UPLOAD_ENCODINGS}, not {self.uploadEncoding!r}")
+
+        if self.profile not in PROFILE_MODES:
+            raise ValueError(
+                f"profile must be one of {PROFILE_MODES}, not {self.profile!r}")
+
+        # Used in modulo and deque sizes, 0 would stop every telegram
+        for name in ["sampleEvery", "batchSize", "checkpointInterval", "ringSize", "baudRate"]:
+            if getattr(self, name) < 1:
+                raise ValueError(f"{name} must be at least 1")
+
+        if self.dataQuantity < 0:
+            raise ValueError("dataQuantity must be 0 or more")
+
+        if not 0 < self.localApiPort < 65536:
+            raise ValueError("localApiPort must be between 1 and 65535")
+
+        if not isinstance(self.sendSchema, dict):
+            raise ValueError(
+                "sendSchema must map field names to OBIS codes")
+
+        for name, code in self.sendSchema.items():
+            # Fields of the upload API can't be redefined
+            if name in OBIS_FOR_SEND or name == "meterId":
+                raise ValueError(
+                    f"sendSchema field {name!r} is already sent")
+
+            if not isinstance(code, str) or code not in OBIS_CODES or code in NON_NUMERIC_OBIS:
+                raise ValueError(
+                    f"sendSchema field {name!r} needs a numeric OBIS code, not {code!r}")
+
+
+# Settings that are applied while running, others need a restart
+HOT_RELOAD_SETTINGS = ["debug", "dataQuantity", "sampleEvery", "uploadEncoding",
+                       "batchSize", "sendExtraData", "sendSchema", "checkpointInterval"]
+
+# Profilers for the main loop, "" is off
+PROFILE_MODES = ["", "cprofile", "sampling"]
+
+# Encodings that encodeBody can produce
+UPLOAD_ENCODINGS = ["identity", "gzip", "deflate"]
+
+# Max. amount of readings kept while the server can't be reached
+MAX_PENDING_DATA = 24 * 60 * 6
+
+# Upload errors worth retrying, other 4xx responses drop the reading
+RETRY_STATUSES = [401, 429]
+
+# Seconds to wait for the server on uploads
+UPLOAD_TIMEOUT = 30
+
+# Media type for columnar batches, only used when the server advertises it
+COLUMNAR_TYPE = "application/vnd.meterdata.columnar+json"
+
+# Cumulative counters, these are delta coded in columnar batches
+DELTA_FIELDS = ["totalConsumptionDay", "totalConsumptionNight",
+                "gasConsumption", "totalProductionDay", "totalProductionNight"]
+
+# Seconds between keepalive comments on the stream
+STREAM_KEEPALIVE = 15
+
+# Max. amount of rollups kept while the server can't be reached
+MAX_PENDING_ROLLUPS = 24 * 7
+
+# Seconds without telegrams after which energy used can't be put in an hour
+MAX_TELEGRAM_GAP = 15 * 60
+
+# Seconds before rollups are sent again after a failed upload
+ROLLUP_RETRY_DELAY = 5 * 60
+
+# Hours ahead of UTC for the DST flag of the telegram timestamp (W)inter, (S)ummer
+DST_OFFSETS = {"W": 1, "S": 2}
+
+# Stages in the trace, index is stored in the file
+# idle is the wait for the start of a telegram, read is from '/' up to '!'
+TRACE_STAGES = ["read", "crc", "parse", "process", "send", "idle"]
+STAGE_READ, STAGE_CRC, STAGE_PARSE, STAGE_PROCESS, STAGE_SEND, STAGE_IDLE = range(
+    6)
+
+# Trace file layout: header, then (telegram, stage, start ns, duration ns)
+TRACE_HEADER = b"P1TRACE1"
+TRACE_RECORD = struct.Struct('<IBQQ')
+
+# Seconds between samples of the sampling profiler
+SAMPLE_INTERVAL = 0.005
+
+# inotify events for a file written or moved into the watched directory
+IN_CLOSE_WRITE = 0x08
+IN_MOVED_TO = 0x80
+INOTIFY_EVENT = struct.Struct('iIII')
 
 
 # All OBIS codes with description
@@ -45,6 +231,9 @@ OBIS_CODES = {
     "1-0:2.8.1":    "Rate 1 (day) - total production",
     "1-0:2.8.2":    "Rate 2 (night) - total production",
     "0-0:96.14.0":  "Current rate (1=day,2=night)",
+    "1-0:1.4.0":    "Current average demand (quarter-hour)",
+    "1-0:1.6.0":    "Maximum demand current month (timestamp) (value)",
+    "0-0:98.1.0":   "Maximum demand last 13 months",
     "1-0:1.7.0":    "All phases consumption",
     "1-0:2.7.0":    "All phases production",
     "1-0:21.7.0":   "L1 consumption",
@@ -69,13 +258,62 @@ OBIS_CODES = {
     "0-1:24.2.3":   "Reading from natural gas meter (timestamp) (value)",
 }
 
-OBIS_FOR_SEND = ["0-0:1.0.0", "1-0:1.8.1",
-                 "1-0:1.8.2", "1-0:1.7.0", "0-1:24.2.3"]
+# OBIS code for every description, used by the local API
+OBIS_DESCRIPTIONS = {description: code for code,
+                     description in OBIS_CODES.items()}
+
+# Payload field for every OBIS code that is always uploaded
+OBIS_FOR_SEND = {
+    "date":                     "0-0:1.0.0",
+    "totalConsumptionDay":      "1-0:1.8.1",
+    "totalConsumptionNight":    "1-0:1.8.2",
+    "allPhaseConsumption":      "1-0:1.7.0",
+    "gasConsumption":           "0-1:24.2.3",
+}
+
+# Production and per phase fields, only added when the meter reports them
+OBIS_FOR_SEND_EXTRA = {
+    "totalProductionDay":       "1-0:2.8.1",
+    "totalProductionNight":     "1-0:2.8.2",
+    "allPhaseProduction":       "1-0:2.7.0",
+    "consumptionL1":            "1-0:21.7.0",
+    "consumptionL2":            "1-0:41.7.0",
+    "consumptionL3":            "1-0:61.7.0",
+    "productionL1":             "1-0:22.7.0",
+    "productionL2":             "1-0:42.7.0",
+    "productionL3":             "1-0:62.7.0",
+    "voltageL1":                "1-0:32.7.0",
+    "voltageL2":                "1-0:52.7.0",
+    "voltageL3":                "1-0:72.7.0",
+    "currentL1":                "1-0:31.7.0",
+    "currentL2":                "1-0:51.7.0",
+    "currentL3":                "1-0:71.7.0",
+}
+
+# OBIS codes with text values, these can't be uploaded as number
+NON_NUMERIC_OBIS = ["0-0:96.1.1", "0-1:96.1.1", "0-0:96.13.0", "0-0:98.1.0"]
+
+# Equipment identifiers (serial numbers), not shown by the local API
+PRIVATE_OBIS = ["0-0:96.1.1", "0-1:96.1.1"]
+
+# Convert setting from file or environment to the type of the setting
+
+
+def convertSetting(settingType, value):
+    if settingType is bool and isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+
+    # Environment gives JSON text, e.g. P1_SEND_SCHEMA='{"voltageL1": "1-0:32.7.0"}'
+    # Type is checked when the config is created
+    if settingType is dict:
+        return json.loads(value) if isinstance(value, str) else value
+
+    return settingType(value)
 
 # Compare given CRC to calculated CRC
 
 
-def checkCRC(p1Object):
+def checkCRC(p1Object, debug=False):
     objectCRC = -1
 
     # Try to find the '!' character, CRC is right after '!'
@@ -98,7 +336,7 @@ def checkCRC(p1Object):
     crc16 = hex(crcmod.predefined.mkPredefinedCrcFun(
         'crc16')(p1Object[:crcIndex + 1]))
 
-    if DEBUG:
+    if debug:
         print("Calculated CRC:", crc16)
         print("Object CRC:", objectCRC)
 
@@ -109,307 +347,1299 @@ def checkCRC(p1Object):
     # Invalid CRC
     return False
 
-# Extract OBIS line from data
+# Convert telegram timestamp (YYMMDDhhmmss) to datetime, with UTC offset when
+# the DST flag is given so the repeated hour in autumn is a different time
+
+
+def parseTimestamp(value, dst=""):
+    timestamp = datetime.strptime(str(int(value)), '%y%m%d%H%M%S')
+
+    if dst in DST_OFFSETS:
+        timestamp = timestamp.replace(
+            tzinfo=timezone(timedelta(hours=DST_OFFSETS[dst])))
+
+    return timestamp
+
+# Convert list of meterDataDTO's to one object with a list per field
+
 
+def encodeColumnar(meterData):
+    dateFormat = '%Y-%m-%d %H:%M:%S'
+    dates = [datetime.strptime(dto["date"], dateFormat) for dto in meterData]
 
-def extractObisData(telegramLine):
-    global METER_ID
-    unit = ""
-    timestamp = ""
+    columns = {
+        "meterId":  meterData[0]["meterId"],
+        "count":    len(meterData),
+        # First date, followed by seconds since previous reading
+        "date": {
+            "start":    meterData[0]["date"],
+            "delta":    [int((b - a).total_seconds()) for a, b in zip(dates, dates[1:])],
+        },
+    }
+
+    # Optional fields can be missing in some readings, those are sent as null
+    allFields = dict.fromkeys(field for dto in meterData for field in dto)
+
+    for field in allFields:
+        if field in columns:
+            continue
+
+        values = [dto.get(field) for dto in meterData]
+
+        # Counters only go up, send differences with previous present value in
+        # thousandths, missing values are skipped and the first value is relative to 0
+        if field in DELTA_FIELDS:
+            deltas = []
+            previous = 0
 
-    if DEBUG:
-        print(f"Parsing: {telegramLine}")
+            for value in values:
+                if value is None:
+                    deltas.append(None)
+                    continue
+
+                scaled = round(value * 1000)
+                deltas.append(scaled - previous)
+                previous = scaled
+
+            columns[field] = {
+                "scale":    1000,
+                "delta":    deltas,
+            }
+        else:
+            columns[field] = values
 
-    # OBIS code and value is seperated by '(' character
-    obis = telegramLine.split("(")[0]
+    return columns
 
-    # Check our dict of OBIS codes
-    if obis in OBIS_CODES:
-        # Value is right after '(' char
-        values = re.findall(r'\(.*?\)', telegramLine)
-        value = values[0][1:-1]
+# Start new hourly buckets
 
-        # Some values might be empty, skip those
-        if len(value) > 0:
 
-            #  Timestamps need the last char removed
-            if obis == "0-0:1.0.0" or len(values) > 1:
-                value = value[:-1]
+def resetHour(state):
+    state["hourConsumption"] = {}
+    state["hourProduction"] = {}
+    state["hourGas"] = 0.0
+    state["hourPeak"] = 0.0
+    state["hourPeakTime"] = None
 
-            # Gas meter has more than one value, first one is timestamp
-            if len(values) > 1:
-                timestamp = value
-                value = values[1][1:-1]
+# Keep highest quarter-hour demand of the hour
 
-            # Parsing for serial number
-            if "96.1.1" in obis:
-                value = bytearray.fromhex(value).decode()
 
-                if "0-0:96.1.1" in obis:
-                    METER_ID = value
+def closeQuarter(state):
+    if state["quarterDemand"] > state["hourPeak"]:
+        state["hourPeak"] = state["quarterDemand"]
+        state["hourPeakTime"] = state["quarter"]
 
-                    if DEBUG:
-                        print("\nSerial Number:", value)
-                        print("")
+# Print p50/p99 per stage of a trace file
 
+
+def summarizeTrace(path):
+    with open(path, 'rb') as traceFile:
+        data = traceFile.read()
+
+    if not data.startswith(TRACE_HEADER):
+        print("Not a trace file:", path)
+        return
+
+    # Cut off incomplete record at the end, e.g. after a crash
+    data = data[len(TRACE_HEADER):]
+    data = data[:len(data) - len(data) % TRACE_RECORD.size]
+
+    durations = [[] for stage in TRACE_STAGES]
+    for telegram, stage, start, duration in TRACE_RECORD.iter_unpack(data):
+        durations[stage].append(duration)
+
+    rows = []
+    for stage, values in enumerate(durations):
+        if values == []:
+            continue
+
+        values.sort()
+        rows.append((TRACE_STAGES[stage], len(values),
+                     round(percentile(values, 50) / 1e6, 3),
+                     round(percentile(values, 99) / 1e6, 3),
+                     round(values[-1] / 1e6, 3)))
+
+    print(tabulate(rows, headers=['Stage', 'Count', 'p50 (ms)', 'p99 (ms)', 'Max (ms)'],
+                   tablefmt='pretty'))
+
+# Nearest-rank percentile of sorted list
+
+
+def percentile(values, percent):
+    index = max(0, -(-len(values) * percent // 100) - 1)
+    return values[index]
+
+# Count where given thread is every SAMPLE_INTERVAL seconds
+
+
+def sampleThread(threadId, samples, stopSampling):
+    while not stopSampling.wait(SAMPLE_INTERVAL):
+        frame = sys._current_frames().get(threadId)
+
+        if frame is None:
+            continue
+
+        location = f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}:{frame.f_lineno}"
+        samples[location] = samples.get(location, 0) + 1
+
+
+# One P1 meter with its own settings, API session and data
+class P1Meter:
+    def __init__(self, config):
+        self.config = config
+        self.running = True
+
+        self.piKey = ""
+        self.meterId = -1
+        self.meterIdDb = -1
+        self.apiToken = ""
+
+        # OBIS description to payload fields, built once from the schema
+        self.sendFields = {}
+
+        # Upload formats accepted by the server, None until negotiated
+        self.serverEncodings = None
+        self.serverColumnar = False
+
+        # Readings waiting to be uploaded
+        self.pendingData = []
+
+        # Recent telegrams, newest last, guarded by telegramEvent
+        self.telegramRing = deque(maxlen=config.ringSize)
+        self.telegramEvent = threading.Condition()
+        self.telegramCounter = 0
+
+        # Running aggregator state
+        self.aggregate = {}
+
+        # Monotonic time before which rollups are not sent again
+        self.rollupRetryAt = 0.0
+
+        # Open trace file, None while tracing is off
+        self.traceOutput = None
+
+    # Apply hot reloadable settings of new config, others need a restart
+    def reloadConfig(self, config):
+        changes = {}
+
+        for setting in fields(Config):
+            newValue = getattr(config, setting.name)
+
+            if newValue == getattr(self.config, setting.name):
+                continue
+
+            if setting.name in HOT_RELOAD_SETTINGS:
+                changes[setting.name] = newValue
             else:
-                lvalue = value.split("*")
-                value = float(lvalue[0])
+                print(f"Setting {setting.name} changed, restart to apply\n")
 
-                if len(lvalue) > 1:
-                    unit = lvalue[1]
+        if changes == {}:
+            return
 
-            if DEBUG:
-                print(
-                    f"Description: {OBIS_CODES[obis]}, value:{value}, unit:{unit}\n")
+        # Swap whole config at once, main loop never sees half an update
+        self.config = replace(self.config, **changes)
 
-            return (OBIS_CODES[obis], value, unit)
-    else:
-        return ()
+        if "sendExtraData" in changes or "sendSchema" in changes:
+            self.buildSendFields()
 
-# Send json object to Database
+        if "uploadEncoding" in changes or "batchSize" in changes:
+            self.serverEncodings = None
 
+        print("Config reloaded:", changes, "\n")
 
-def sendData(obisOutput):
-    global METER_ID, METER_ID_DB, SEND_URL, LOGIN_URL, API_TOKEN
+    # Extract OBIS line from data
+    def extractObisData(self, telegramLine):
+        unit = ""
+        timestamp = ""
+        debug = self.config.debug
 
-    # Login
-    if API_TOKEN == "":
-        userDto = {
-            "email": API_USERNAME,
-            "password": API_PW,
-        }
-        response = json.loads(requests.post(LOGIN_URL, json=userDto).content)
-        API_TOKEN = 'Bearer ' + response['token']
-
-    if METER_ID_DB == -1:
-        getDBMeterID()
-
-    # Add required data to list
-    sendObject = []
-
-    for code in OBIS_FOR_SEND:
-        # Find required obis codes
-        found = list(
-            filter(lambda x: x[0] == OBIS_CODES[code], obisOutput))
-        sendObject.append(found)
-
-    # Format Datetime
-    dateString = str(int(sendObject[0][0][1]))
-    formatDate = datetime.strptime(
-        dateString, '%y%m%d%H%M%S')
-
-    meterDataDTO = {
-        "date":                     str(formatDate),
-        "meterId":                  int(METER_ID_DB),
-        "totalConsumptionDay":      float(sendObject[1][0][1]),
-        "totalConsumptionNight":    float(sendObject[2][0][1]),
-        "allPhaseConsumption":      float(sendObject[3][0][1]),
-        "gasConsumption":           float(sendObject[4][0][1]),
-    }
+        if debug:
+            print(f"Parsing: {telegramLine}")
+
+        # OBIS code and value is seperated by '(' character
+        obis = telegramLine.split("(")[0]
+
+        # Check our dict of OBIS codes
+        if obis in OBIS_CODES:
+            # Value is right after '(' char
+            values = re.findall(r'\(.*?\)', telegramLine)
+            value = values[0][1:-1]
+
+            # Monthly peak buffer: (count)(obis)(obis), then (month)(time)(value) per month
+            if obis == "0-0:98.1.0":
+                value = [[values[i + 1][1:-2], float(values[i + 2][1:-1].split("*")[0])]
+                         for i in range(3, len(values) - 2, 3)]
+                unit = "kW"
+
+                if debug:
+                    print(
+                        f"Description: {OBIS_CODES[obis]}, value:{value}, unit:{unit}\n")
 
-    if DEBUG:
-        print(meterDataDTO)
+                return (OBIS_CODES[obis], value, unit)
 
-    headers = {'Content-Type': 'application/json', 'Authorization': API_TOKEN}
-    response = requests.post(
-        SEND_URL, headers=headers, json=meterDataDTO, verify=True)
+            # Some values might be empty, skip those
+            if len(value) > 0:
 
-    if DEBUG:
-        print(response.content)
-        print(response.status_code)
+                #  Timestamps need the last char removed
+                if obis == "0-0:1.0.0" or len(values) > 1:
+                    # DST flag of the telegram timestamp is kept as unit
+                    if obis == "0-0:1.0.0":
+                        unit = value[-1]
 
-    if response.status_code == 201:
-        print("Data successfully submitted\n")
-    elif response.status_code == 400:
-        print("Error while trying to submit data\n")
+                    value = value[:-1]
 
+                # Gas meter has more than one value, first one is timestamp
+                if len(values) > 1:
+                    timestamp = value
+                    value = values[1][1:-1]
 
-def mainLoop():
-    # Setup serial port, with specified BAUD_RATE
-    ser = serial.Serial(PORT, BAUD_RATE, xonxoff=1)
+                # Parsing for serial number
+                if "96.1.1" in obis:
+                    value = bytearray.fromhex(value).decode()
 
-    # Create bytearray for storing all values
-    p1Telegram = bytearray()
+                    if "0-0:96.1.1" in obis:
+                        self.meterId = value
 
-    # For stopping the program once data was received and processed.
-    gotData = False
-    dataQuantity = 1
-    dataCounter = 0
+                        if debug:
+                            print("\nSerial Number:", value)
+                            print("")
+
+                else:
+                    lvalue = value.split("*")
+                    value = float(lvalue[0])
+
+                    if len(lvalue) > 1:
+                        unit = lvalue[1]
+
+                if debug:
+                    print(
+                        f"Description: {OBIS_CODES[obis]}, value:{value}, unit:{unit}\n")
+
+                return (OBIS_CODES[obis], value, unit)
+        else:
+            return ()
+
+    # Send json object to Database
+    def sendData(self, obisOutput):
+        self.apiLogin()
+
+        if self.meterIdDb == -1:
+            self.getDBMeterID()
+
+        meterDataDTO = self.buildMeterDataDTO(obisOutput)
+
+        if self.config.debug:
+            print(meterDataDTO)
+
+        self.pendingData.append(meterDataDTO)
+
+        # Upload once the batch is full
+        if len(self.pendingData) >= self.config.batchSize:
+            self.flushData()
+
+    # Get API token, only once
+    def apiLogin(self):
+        if self.apiToken == "":
+            if self.config.apiUsername == "" or self.config.apiPassword == "":
+                raise ValueError(
+                    "apiUsername and apiPassword must be set to send data")
+
+            userDto = {
+                "email": self.config.apiUsername,
+                "password": self.config.apiPassword,
+            }
+            response = json.loads(requests.post(
+                self.config.loginUrl, json=userDto).content)
+            self.apiToken = 'Bearer ' + response['token']
+
+    # Map OBIS descriptions to payload fields
+    def buildSendFields(self):
+        schema = dict(OBIS_FOR_SEND)
+        if self.config.sendExtraData:
+            schema.update(OBIS_FOR_SEND_EXTRA)
+        schema.update(self.config.sendSchema)
+
+        # One OBIS code can fill several fields
+        sendFields = {}
+        for field, code in schema.items():
+            sendFields.setdefault(OBIS_CODES[code], []).append(field)
+
+        # Replace at once, a reload can happen while a DTO is being built
+        self.sendFields = sendFields
+
+    # Create meterDataDTO in one pass over the extracted OBIS data
+    def buildMeterDataDTO(self, obisOutput):
+        if self.sendFields == {}:
+            self.buildSendFields()
+
+        sendFields = self.sendFields
+        meterDataDTO = {"meterId": int(self.meterIdDb)}
+
+        for description, value, unit in obisOutput:
+            for field in sendFields.get(description, []):
+                meterDataDTO[field] = float(value)
+
+        # Extra fields are optional, the base fields are not
+        for field in OBIS_FOR_SEND:
+            if field not in meterDataDTO:
+                raise KeyError(f"{field} not found in telegram.")
+
+        # Format Datetime
+        meterDataDTO["date"] = str(parseTimestamp(meterDataDTO["date"]))
+
+        return meterDataDTO
+
+    # Upload all pending readings
+    def flushData(self):
+        if self.pendingData == []:
+            return
+
+        if self.serverEncodings is None:
+            self.negotiateUpload()
+
+        pendingData = self.pendingData
+        self.pendingData = []
+
+        # Readings are only dropped after the server accepted or rejected them
+        unsent = pendingData
 
-    while not gotData:
         try:
-            # Read next line from serial input
-            p1Line = ser.readline()
-
-            # Decode line to ascii charset
-            asciiLine = p1Line.decode('ascii')
-
-            # Start of telegram is always a '/' character
-            if '/' in asciiLine:
-                # Clear telegram for current transmission
-                p1Telegram = bytearray()
-
-                if DEBUG:
-                    print("Beginning of telegram\n")
-
-            # Add current line to our byte array, encoded as ascii
-            p1Telegram.extend(asciiLine.encode('ascii'))
-
-            # Telegram always end with '!' character followed by a CRC
-            if '!' in asciiLine:
-                if DEBUG:
-                    print('*' * 40)
-                    print(p1Telegram.decode('ascii').strip())
-                    print('*' * 40)
-                    print("\nEND!\n")
-
-                # Calculate CRC and compare with given
-                if checkCRC(p1Telegram):
-
-                    if DEBUG:
-                        print("CRC Matches, extracting data...\n\n")
-
-                    # List for constructing our output
-                    output = []
-
-                    # Split over new line, every line contains different data
-                    for line in p1Telegram.split(b'\n'):
-
-                        # Extract our OBIS data
-                        r = extractObisData(
-                            line.decode('ascii'))
-
-                        # Append data to our list if not empty
-                        if r:
-                            output.append(r)
-                            if DEBUG:
-                                print(
-                                    f"Desc: {r[0]}, val: {r[1]}, u:{r[2]}")
-
-                    # Print nice table overview of our data
-                    if DEBUG:
-                        print(tabulate(output, headers=['Description', 'Value', 'Unit'],
-                                       tablefmt='pretty'))
-
-                    if SEND_DATA:
-                        sendData(output)
-                    dataCounter += 1
-                    # Data was received and formatted, stop running
-                    if dataCounter >= dataQuantity:
-                        gotData = True
+            # Columnar batch if the server supports it, otherwise one by one
+            if len(pendingData) > 1 and self.serverColumnar:
+                response = self.postPayload(
+                    encodeColumnar(pendingData), COLUMNAR_TYPE)
+
+                # Refused as columnar, keep batch to send one by one
+                if response.status_code == 415 and not self.serverColumnar:
+                    pass
+                elif not self.keepForRetry(response):
+                    unsent = []
+            else:
+                for index, dto in enumerate(pendingData):
+                    unsent = pendingData[index:]
 
+                    # Server unavailable, don't post the rest of the queue now
+                    if self.keepForRetry(self.postPayload(dto)):
+                        break
                 else:
-                    if DEBUG:
-                        print("CRC DOESN'T MATCH")
+                    unsent = []
 
-        except Exception as e:
-            print("EXCEPTION:", e)
+        finally:
+            # Keep unsent readings for next upload, oldest first
+            self.pendingData = (
+                unsent + self.pendingData)[-MAX_PENDING_DATA:]
 
-            if DEBUG:
-                traceback.print_exc()
+    # Print upload result, True if the data should be sent again later
+    def keepForRetry(self, response):
+        status = response.status_code
 
-        except KeyboardInterrupt:
-            # Close serial port for future use
-            ser.close()
-            print("CLOSING PROGRAM")
-            break
+        if self.config.debug:
+            print(response.content)
+            print(status)
 
-    # Close serial port when exiting
-    ser.close()
+        if status == 201:
+            print("Data successfully submitted\n")
+            return False
 
-# Try to get meter id from database
+        # Token expired, login again on next upload
+        if status == 401:
+            self.apiToken = ""
 
+        if status in RETRY_STATUSES or status >= 500:
+            print(f"Server can't store data now ({status}), retrying later\n")
+            return True
 
-def getDBMeterID():
-    global METER_ID, GET_USER_METERS, PI_KEY, METER_ID_DB, API_TOKEN
+        print(f"Error while trying to submit data ({status}), dropped\n")
+        return False
 
-    print("Trying to get METER ID...\n")
+    # Ask the server which upload formats it accepts
+    def negotiateUpload(self):
+        serverEncodings = []
+        self.serverColumnar = False
 
-    if METER_ID != -1 and METER_ID_DB == -1:
-        headers = {
-            'Authorization': API_TOKEN
+        # Plain JSON needs no negotiation
+        if self.config.uploadEncoding == "identity" and self.config.batchSize <= 1:
+            self.serverEncodings = serverEncodings
+            return
+
+        # Network can still be down at boot, ask again on next upload
+        try:
+            response = requests.options(
+                self.config.sendUrl, headers={'Authorization': self.apiToken})
+        except requests.RequestException as e:
+            print("Could not negotiate upload format:", e)
+            self.serverEncodings = None
+            return
+
+        self.serverEncodings = serverEncodings
+
+        # Accepted request codings are listed in Accept-Encoding (RFC 7694)
+        for coding in response.headers.get('Accept-Encoding', '').split(','):
+            coding = coding.split(';')[0].strip().lower()
+
+            if len(coding) > 0:
+                serverEncodings.append(coding)
+
+        # Accepted media types are listed in Accept-Post
+        self.serverColumnar = COLUMNAR_TYPE in response.headers.get(
+            'Accept-Post', '')
+
+        if self.config.debug:
+            print("Server encodings:", serverEncodings)
+            print("Server columnar:", self.serverColumnar)
+
+    # Encode payload as compact JSON, compressed when the server allows it
+    def encodeBody(self, payload, contentType='application/json'):
+        uploadEncoding = self.config.uploadEncoding
+
+        body = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+        headers = {'Content-Type': contentType,
+                   'Authorization': self.apiToken}
+
+        if uploadEncoding in (self.serverEncodings or []):
+            if uploadEncoding == "gzip":
+                body = gzip.compress(body, mtime=0)
+                headers['Content-Encoding'] = uploadEncoding
+            elif uploadEncoding == "deflate":
+                body = zlib.compress(body)
+                headers['Content-Encoding'] = uploadEncoding
+
+        return (body, headers)
+
+    # Post payload, falls back to plain JSON if the server refuses compression
+    def postPayload(self, payload, contentType='application/json', url=None):
+        url = url or self.config.sendUrl
+
+        body, headers = self.encodeBody(payload, contentType)
+        response = requests.post(
+            url, headers=headers, data=body, verify=True, timeout=UPLOAD_TIMEOUT)
+
+        # 415 Unsupported Media Type, server no longer accepts the encoding
+        if response.status_code == 415 and 'Content-Encoding' in headers:
+            print("Compressed upload refused, sending plain JSON\n")
+            self.serverEncodings = []
+
+            body, headers = self.encodeBody(payload, contentType)
+            response = requests.post(
+                url, headers=headers, data=body, verify=True, timeout=UPLOAD_TIMEOUT)
+
+        # Columnar batch refused, send readings one by one from now on
+        if response.status_code == 415 and contentType == COLUMNAR_TYPE:
+            print("Columnar upload refused, sending readings one by one\n")
+            self.serverColumnar = False
+
+        return response
+
+    # Update running totals with one telegram, O(1) per telegram
+    def updateAggregate(self, obisOutput):
+        values = {OBIS_DESCRIPTIONS[r[0]]: r[1] for r in obisOutput}
+
+        # Unit of the timestamp is the DST flag
+        dst = next(r[2] for r in obisOutput
+                   if OBIS_DESCRIPTIONS[r[0]] == "0-0:1.0.0")
+        timestamp = parseTimestamp(values["0-0:1.0.0"], dst)
+        hour = str(timestamp.replace(minute=0, second=0))
+        quarter = str(timestamp.replace(
+            minute=timestamp.minute - timestamp.minute % 15, second=0))
+
+        tariff = str(int(values.get("0-0:96.14.0", 1)))
+        consumption = values.get("1-0:1.8.1", 0.0) + \
+            values.get("1-0:1.8.2", 0.0)
+        production = values.get("1-0:2.8.1", 0.0) + \
+            values.get("1-0:2.8.2", 0.0)
+        gas = values.get("0-1:24.2.3")
+
+        # First telegram ever, counters so far are not ours
+        if self.aggregate == {}:
+            self.aggregate = {
+                "hour":                 hour,
+                "quarter":              quarter,
+                "telegrams":            0,
+                "consumption":          consumption,
+                "production":           production,
+                "gas":                  gas,
+                "quarterStart":         consumption,
+                "quarterDemand":        0.0,
+                "monthPeak":            None,
+                "monthPeaks":           [],
+                "monthPeaksSent":       [],
+                "rollups":              [],
+            }
+            resetHour(self.aggregate)
+
+        state = self.aggregate
+
+        # Quarter is closed before the hour, so its peak ends up in the right hour
+        if quarter != state["quarter"]:
+            closeQuarter(state)
+            state["quarter"] = quarter
+            state["quarterStart"] = state["consumption"]
+            state["quarterDemand"] = 0.0
+
+        if hour != state["hour"]:
+            self.closeHour(state)
+            state["hour"] = hour
+
+        # Energy since previous telegram
+        # Counters can only go down when the meter was replaced, skip those
+        used = max(0.0, consumption - state["consumption"])
+        delivered = max(0.0, production - state["production"])
+        gasUsed = 0.0
+
+        if gas is not None:
+            if state["gas"] is not None:
+                gasUsed = max(0.0, gas - state["gas"])
+            state["gas"] = gas
+
+        # After downtime the energy can't be split over hours and tariffs,
+        # send it as separate rollup spanning the gap
+        lastTelegram = state.get("lastTelegram")
+        if lastTelegram is not None:
+            previous = datetime.fromisoformat(lastTelegram)
+
+            # Checkpoints of older versions have no UTC offset
+            if previous.tzinfo is None:
+                previous = previous.replace(tzinfo=timestamp.tzinfo)
+
+            if (timestamp - previous).total_seconds() > MAX_TELEGRAM_GAP:
+                self.closeGap(state, lastTelegram, str(timestamp),
+                              used, delivered, gasUsed)
+                used = delivered = gasUsed = 0.0
+                state["quarterStart"] = consumption
+
+        # Goes to the current tariff bucket
+        state["hourConsumption"][tariff] = round(
+            state["hourConsumption"].get(tariff, 0.0) + used, 3)
+        state["hourProduction"][tariff] = round(
+            state["hourProduction"].get(tariff, 0.0) + delivered, 3)
+        state["hourGas"] = round(state["hourGas"] + gasUsed, 3)
+        state["consumption"] = consumption
+        state["production"] = production
+        state["lastTelegram"] = str(timestamp)
+
+        # Use average demand from meter, otherwise energy this quarter * 4
+        if "1-0:1.4.0" in values:
+            state["quarterDemand"] = values["1-0:1.4.0"]
+        else:
+            state["quarterDemand"] = round(
+                (consumption - state["quarterStart"]) * 4, 3)
+
+        if "1-0:1.6.0" in values:
+            state["monthPeak"] = values["1-0:1.6.0"]
+
+        if "0-0:98.1.0" in values:
+            state["monthPeaks"] = values["0-0:98.1.0"]
+
+        state["telegrams"] += 1
+
+        if state["telegrams"] % self.config.checkpointInterval == 0:
+            self.saveCheckpoint()
+
+    # Turn current hour into rollup for upload
+    def closeHour(self, state):
+        rollup = {
+            "hour":             state["hour"],
+            "consumption":      state["hourConsumption"],
+            "production":       state["hourProduction"],
+            "gasConsumption":   state["hourGas"],
+            "peakDemand":       state["hourPeak"],
+            "peakDemandTime":   state["hourPeakTime"],
+            "monthPeakDemand":  state["monthPeak"],
         }
-        response = requests.get(GET_USER_METERS, headers=headers)
 
-        jsonObject = json.loads(response.content)
+        # Monthly buffer only changes once a month, only send it when it did
+        if state["monthPeaks"] != state["monthPeaksSent"]:
+            rollup["monthPeaks"] = state["monthPeaks"]
+            state["monthPeaksSent"] = state["monthPeaks"]
+
+        if self.config.debug:
+            print("Rollup:", rollup)
+
+        state["rollups"] = (state["rollups"] + [rollup])[-MAX_PENDING_ROLLUPS:]
+        resetHour(state)
+        self.saveCheckpoint()
+
+    # Rollup for energy used while no telegrams were received
+    def closeGap(self, state, start, end, used, delivered, gasUsed):
+        rollup = {
+            "from":             start,
+            "until":            end,
+            "gap":              True,
+            "consumption":      {"total": round(used, 3)},
+            "production":       {"total": round(delivered, 3)},
+            "gasConsumption":   round(gasUsed, 3),
+        }
+
+        print(f"No telegrams from {start} until {end}\n")
+
+        state["rollups"] = (state["rollups"] + [rollup])[-MAX_PENDING_ROLLUPS:]
+
+    # Write aggregator state, through a temporary file so a crash can't corrupt it
+    def saveCheckpoint(self):
+        if self.aggregate == {}:
+            return
+
+        checkpointFile = self.config.checkpointFile
+        tempFile = checkpointFile + ".tmp"
+        with open(tempFile, 'w') as checkpoint:
+            json.dump(self.aggregate, checkpoint)
+
+            # Data must be on the SD card before the rename, or a power cut
+            # can leave an empty checkpoint
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+
+        os.replace(tempFile, checkpointFile)
+
+        # Store the rename itself
+        directory = os.open(os.path.dirname(
+            os.path.abspath(checkpointFile)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    # Continue from last checkpoint, if any
+    def loadCheckpoint(self):
+        if not os.path.exists(self.config.checkpointFile):
+            return
+
+        try:
+            with open(self.config.checkpointFile) as checkpoint:
+                self.aggregate = json.load(checkpoint)
+
+            print("Checkpoint loaded.\n")
+
+        except ValueError as e:
+            print("Cannot read checkpoint: {0}\n".format(e))
+
+    # Upload finished hourly rollups, oldest first
+    def sendRollups(self):
+        rollups = self.aggregate.get("rollups", [])
+
+        if rollups == [] or time.monotonic() < self.rollupRetryAt:
+            return
+
+        # Wait before trying again, unless every rollup gets sent
+        self.rollupRetryAt = time.monotonic() + ROLLUP_RETRY_DELAY
+        sent = False
+
+        try:
+            self.apiLogin()
+
+            if self.meterIdDb == -1:
+                self.getDBMeterID()
+
+            while rollups != []:
+                rollup = dict(rollups[0], meterId=int(self.meterIdDb))
+                response = self.postPayload(rollup, url=self.config.rollupUrl)
+
+                if self.config.debug:
+                    print(response.content)
+                    print(response.status_code)
+
+                # Keep rollup for next time
+                if response.status_code != 201:
+                    print("Error while trying to submit rollup\n")
+                    break
+
+                rollups.pop(0)
+                sent = True
+            else:
+                self.rollupRetryAt = 0.0
+
+        finally:
+            # Only write to the SD card when the queue changed
+            if sent:
+                self.saveCheckpoint()
+
+    def mainLoop(self):
+        config = self.config
+
+        # Setup serial port, with specified baud rate
+        ser = serial.Serial(config.port, config.baudRate, xonxoff=1)
+
+        # Create bytearray for storing all values
+        p1Telegram = bytearray()
+
+        # For stopping the program once data was received and processed.
+        gotData = False
+        dataCounter = 0
+        validCounter = 0
+
+        # Trace timestamps, only used when tracing is on
+        # Every telegram gets its own number in the trace, also skipped ones
+        trace = config.trace
+        traceCounter = 0
+        telegramStart = 0
+        stageStart = 0
+
+        # Trace file is closed however the loop ends
+        try:
+            while not gotData and self.running:
+                try:
+                    # Pick up reloaded settings
+                    config = self.config
+                    debug = config.debug
+
+                    if trace:
+                        lineStart = time.perf_counter_ns()
+
+                    # Read next line from serial input
+                    p1Line = ser.readline()
+
+                    # Decode line to ascii charset
+                    asciiLine = p1Line.decode('ascii')
+
+                    # Start of telegram is always a '/' character
+                    if '/' in asciiLine:
+                        # Clear telegram for current transmission
+                        p1Telegram = bytearray()
+
+                        if trace:
+                            traceCounter += 1
+                            telegramStart = self.traceStage(
+                                traceCounter, STAGE_IDLE, lineStart)
+
+                        if debug:
+                            print("Beginning of telegram\n")
+
+                    # Add current line to our byte array, encoded as ascii
+                    p1Telegram.extend(asciiLine.encode('ascii'))
+
+                    # Telegram always end with '!' character followed by a CRC
+                    if '!' in asciiLine:
+                        if debug:
+                            print('*' * 40)
+                            print(p1Telegram.decode('ascii').strip())
+                            print('*' * 40)
+                            print("\nEND!\n")
+
+                        if trace:
+                            stageStart = self.traceStage(
+                                traceCounter, STAGE_READ, telegramStart)
+
+                        # Calculate CRC and compare with given
+                        crcValid = checkCRC(p1Telegram, debug)
+
+                        if trace:
+                            stageStart = self.traceStage(
+                                traceCounter, STAGE_CRC, stageStart)
+
+                        if crcValid:
+                            validCounter += 1
+
+                            # Skip telegrams in between samples
+                            if (validCounter - 1) % config.sampleEvery != 0:
+                                continue
+
+                            if debug:
+                                print("CRC Matches, extracting data...\n\n")
+
+                            # List for constructing our output
+                            output = []
+
+                            # Split over new line, every line contains different data
+                            for line in p1Telegram.split(b'\n'):
+
+                                # Extract our OBIS data
+                                r = self.extractObisData(
+                                    line.decode('ascii'))
+
+                                # Append data to our list if not empty
+                                if r:
+                                    output.append(r)
+                                    if debug:
+                                        print(
+                                            f"Desc: {r[0]}, val: {r[1]}, u:{r[2]}")
+
+                            # Print nice table overview of our data
+                            if debug:
+                                print(tabulate(output, headers=['Description', 'Value', 'Unit'],
+                                               tablefmt='pretty'))
+
+                            if trace:
+                                stageStart = self.traceStage(
+                                    traceCounter, STAGE_PARSE, stageStart)
+
+                            if config.localApi:
+                                self.publishTelegram(output)
+
+                            if config.aggregateData:
+                                self.updateAggregate(output)
+
+                            if trace:
+                                stageStart = self.traceStage(
+                                    traceCounter, STAGE_PROCESS, stageStart)
+
+                            if config.sendData:
+                                if config.uploadRollups and config.aggregateData:
+                                    self.sendRollups()
+                                else:
+                                    self.sendData(output)
+
+                            if trace:
+                                self.traceStage(
+                                    traceCounter, STAGE_SEND, stageStart)
 
-        # Find correct meter with METER_ID and PI_ID
+                            dataCounter += 1
+                            # Data was received and formatted, stop running
+                            if config.dataQuantity > 0 and dataCounter >= config.dataQuantity:
+                                gotData = True
 
-        foundUserMeter = list(filter(lambda meter: meter['meterDeviceId'] == METER_ID and meter['rpId'] == PI_KEY, list(
-            jsonObject)))
+                        else:
+                            if debug:
+                                print("CRC DOESN'T MATCH")
 
-        if foundUserMeter != []:
-            METER_ID_DB = foundUserMeter[0].get('meterId')
+                except Exception as e:
+                    print("EXCEPTION:", e)
+
+                    if self.config.debug:
+                        traceback.print_exc()
+
+                except KeyboardInterrupt:
+                    # Close serial port for future use
+                    ser.close()
+                    print("CLOSING PROGRAM")
+                    break
+
+            # Close serial port when exiting
+            ser.close()
+
+            # Upload what is left of the last batch
+            if self.config.sendData:
+                try:
+                    self.flushData()
+                except Exception as e:
+                    print("EXCEPTION:", e)
+
+            if self.config.aggregateData:
+                self.saveCheckpoint()
+
+        finally:
+            if self.traceOutput is not None:
+                self.traceOutput.close()
+                self.traceOutput = None
+
+    # Write stage duration to trace file, returns end time as start of next stage
+    def traceStage(self, telegram, stage, start):
+        end = time.perf_counter_ns()
+
+        if self.traceOutput is None:
+            self.traceOutput = open(self.config.traceFile, 'ab')
+
+            # New file, start with header
+            if self.traceOutput.tell() == 0:
+                self.traceOutput.write(TRACE_HEADER)
+
+        self.traceOutput.write(TRACE_RECORD.pack(
+            telegram, stage, start, end - start))
+
+        # Send is the last stage, keep at most one telegram in the buffer
+        if stage == STAGE_SEND:
+            self.traceOutput.flush()
+
+        return end
+
+    # Run main loop with profiler selected in config
+    def profileMainLoop(self):
+        if self.config.profile == "cprofile":
+            profiler = cProfile.Profile()
+            profiler.runcall(self.mainLoop)
+            profiler.dump_stats(self.config.profileFile)
+
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+
+        elif self.config.profile == "sampling":
+            samples = {}
+            stopSampling = threading.Event()
+            sampler = threading.Thread(target=sampleThread, args=(
+                threading.get_ident(), samples, stopSampling), daemon=True)
+
+            sampler.start()
+            try:
+                self.mainLoop()
+            finally:
+                stopSampling.set()
+                sampler.join()
+
+            total = sum(samples.values())
+            rows = [(location, count, round(count * 100 / total, 1))
+                    for location, count in sorted(samples.items(), key=lambda x: -x[1])[:20]]
+
+            print(tabulate(rows, headers=['Location', 'Samples', '%'],
+                           tablefmt='pretty'))
 
-            if DEBUG:
-                print("Meter ID in DB:", METER_ID_DB)
         else:
-            # Meter not found, check if meter exists in DB
+            self.mainLoop()
+
+    # Store telegram for the local API and wake up streaming clients
+    def publishTelegram(self, obisOutput):
+        telegram = {
+            "received": time.time(),
+            "values":   {OBIS_DESCRIPTIONS[r[0]]: [r[1], r[2]] for r in obisOutput
+                         if OBIS_DESCRIPTIONS[r[0]] not in PRIVATE_OBIS},
+        }
+
+        with self.telegramEvent:
+            self.telegramCounter += 1
+            telegram["id"] = self.telegramCounter
+            self.telegramRing.append(telegram)
+            self.telegramEvent.notify_all()
+
+    # Newest telegram, indexing a deque is atomic so no lock is needed
+    def getLatestTelegram(self):
+        try:
+            return self.telegramRing[-1]
+        except IndexError:
+            return None
+
+    # Copy telegrams newer than given id
+    def getTelegrams(self, afterId=0, count=None):
+        count = self.telegramRing.maxlen if count is None else count
+
+        with self.telegramEvent:
+            telegrams = [t for t in self.telegramRing if t["id"] > afterId]
+
+        return telegrams[-count:] if count > 0 else []
+
+    # Serve local API in background thread
+    def startLocalApi(self):
+        # Dashboard server is optional, keep reading the meter without it
+        try:
+            server = ThreadingHTTPServer(
+                (self.config.localApiHost, self.config.localApiPort), LocalApiHandler)
+        except OSError as e:
+            print(
+                f"Cannot start local API on {self.config.localApiHost}:{self.config.localApiPort}: {e}\n")
+            return None
+
+        server.daemon_threads = True
+        server.meter = self
+
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(
+            f"Local API running on {self.config.localApiHost}:{self.config.localApiPort}\n")
+
+        return server
+
+    # Try to get meter id from database
+    def getDBMeterID(self):
+        config = self.config
+
+        print("Trying to get METER ID...\n")
+
+        if self.meterId != -1 and self.meterIdDb == -1:
             headers = {
-                'Authorization': API_TOKEN
+                'Authorization': self.apiToken
             }
-            resp = requests.get(GET_SEND_METERS, headers=headers)
+            response = requests.get(config.getUserMetersUrl, headers=headers)
+
+            jsonObject = json.loads(response.content)
 
-            jsonObj = json.loads(resp.content)
+            # Find correct meter with meterId and piKey
 
-            # Check for meter
-            foundMeteter = list(
-                filter(lambda meter: meter['meterDeviceId'] == METER_ID and meter['rpId'] == PI_KEY, list(jsonObj)))
+            foundUserMeter = list(filter(lambda meter: meter['meterDeviceId'] == self.meterId and meter['rpId'] == self.piKey, list(
+                jsonObject)))
 
-            if foundMeteter != []:
-                METER_ID_DB = foundMeteter[0]['id']
-                if DEBUG:
-                    print("METER FOUND, ID:", METER_ID_DB)
+            if foundUserMeter != []:
+                self.meterIdDb = foundUserMeter[0].get('meterId')
 
+                if config.debug:
+                    print("Meter ID in DB:", self.meterIdDb)
             else:
-                if DEBUG:
-                    print("NO METER YET")
+                # Meter not found, check if meter exists in DB
+                headers = {
+                    'Authorization': self.apiToken
+                }
+                resp = requests.get(config.getSendMetersUrl, headers=headers)
 
-                headers = {'Content-Type': 'application/json',
-                           'Authorization': API_TOKEN}
+                jsonObj = json.loads(resp.content)
 
-                meterDTO = {
-                    "rpId":             PI_KEY,
-                    "meterDeviceId":    METER_ID
-                }
+                # Check for meter
+                foundMeteter = list(
+                    filter(lambda meter: meter['meterDeviceId'] == self.meterId and meter['rpId'] == self.piKey, list(jsonObj)))
 
-                meterResp = requests.post(
-                    GET_SEND_METERS, headers=headers, json=meterDTO)
+                if foundMeteter != []:
+                    self.meterIdDb = foundMeteter[0]['id']
+                    if config.debug:
+                        print("METER FOUND, ID:", self.meterIdDb)
 
-                if meterResp.status_code == 201:
-                    METER_ID_DB = json.loads(meterResp.content)['id']
+                else:
+                    if config.debug:
+                        print("NO METER YET")
+
+                    headers = {'Content-Type': 'application/json',
+                               'Authorization': self.apiToken}
+
+                    meterDTO = {
+                        "rpId":             self.piKey,
+                        "meterDeviceId":    self.meterId
+                    }
+
+                    meterResp = requests.post(
+                        config.getSendMetersUrl, headers=headers, json=meterDTO)
+
+                    if meterResp.status_code == 201:
+                        self.meterIdDb = json.loads(meterResp.content)['id']
+
+                        if config.debug:
+                            print("SET METER ID DB", self.meterIdDb)
+
+                    if config.debug:
+                        print(meterResp.content)
+                        print(meterResp.status_code)
+
+    # Try to find already defined uuid, if none were found create a new one
+    def createUUID(self):
+        keyPath = self.config.keyFile
+
+        mode = 'r+' if os.path.exists(keyPath) else 'w+'
+        with open(keyPath, mode) as keyFile:
+            line = keyFile.readline()
+
+            if len(line) > 0:
+                self.piKey = line
+                print("Key found.\n\n")
+            else:
+                print("Creating key...\n\n")
+                uid = str(uuid.uuid1())
+                keyFile.writelines(uid)
+                self.piKey = uid
+
+
+class LocalApiHandler(BaseHTTPRequestHandler):
+    # GET /latest, /history?n=<count> and /stream (Server-Sent Events)
+    def do_GET(self):
+        meter = self.server.meter
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        if url.path == "/latest":
+            telegram = meter.getLatestTelegram()
+
+            if telegram is None:
+                self.sendJson(404, {"error": "No telegram received yet"})
+            else:
+                self.sendJson(200, telegram)
+
+        elif url.path == "/history":
+            try:
+                count = int(query.get("n", [meter.telegramRing.maxlen])[0])
+            except ValueError:
+                self.sendJson(400, {"error": "n must be a number"})
+                return
+
+            self.sendJson(200, meter.getTelegrams(count=count))
+
+        elif url.path == "/stream":
+            self.streamTelegrams()
+
+        else:
+            self.sendJson(404, {"error": "Unknown path"})
+
+    # Browsers only get access from the configured origin
+    def sendCorsHeader(self):
+        origin = self.server.meter.config.localApiCorsOrigin
+        if origin != "":
+            self.send_header('Access-Control-Allow-Origin', origin)
+
+    def sendJson(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.sendCorsHeader()
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Push every new telegram until the client disconnects
+    def streamTelegrams(self):
+        meter = self.server.meter
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.sendCorsHeader()
+        self.end_headers()
+
+        lastId = meter.telegramCounter
+
+        try:
+            while True:
+                with meter.telegramEvent:
+                    meter.telegramEvent.wait_for(
+                        lambda: meter.telegramCounter > lastId, timeout=STREAM_KEEPALIVE)
+
+                telegrams = meter.getTelegrams(afterId=lastId)
+
+                # Keep connection open when the meter is quiet
+                if telegrams == []:
+                    self.wfile.write(b": keepalive\n\n")
+
+                for telegram in telegrams:
+                    self.wfile.write(
+                        f"id: {telegram['id']}\ndata: {json.dumps(telegram)}\n\n".encode('utf-8'))
+                    lastId = telegram["id"]
+
+                self.wfile.flush()
+
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        if self.server.meter.config.debug:
+            super().log_message(format, *args)
+
+# Reload config of meter when its file changes, uses inotify on Linux
 
-                    if DEBUG:
-                        print("SET METER ID DB", METER_ID_DB)
 
-                if DEBUG:
-                    print(meterResp.content)
-                    print(meterResp.status_code)
+def watchConfig(path, meter):
+    directory = os.path.dirname(os.path.abspath(path))
+    fileName = os.path.basename(path)
 
-# Try to find already defined uuid, if none were found create a new one
+    # Watch directory, editors often replace the file instead of writing it
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        inotifyFd = libc.inotify_init()
+
+        if inotifyFd < 0 or libc.inotify_add_watch(
+                inotifyFd, directory.encode(), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            raise OSError(ctypes.get_errno(), "inotify not available")
+
+    except (OSError, AttributeError, TypeError) as e:
+        print("Watching config without inotify:", e, "\n")
+        inotifyFd = -1
+
+    lastModified = os.path.getmtime(path) if os.path.exists(path) else 0
+
+    while meter.running:
+        changed = False
 
+        if inotifyFd >= 0:
+            events = os.read(inotifyFd, 4096)
+            offset = 0
 
-def createUUID():
-    global PI_KEY
+            while offset < len(events):
+                wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(
+                    events, offset)
+                offset += INOTIFY_EVENT.size
 
-    mode = 'r+' if os.path.exists("./uuid.key") else 'w+'
-    with open("uuid.key", mode) as keyFile:
-        line = keyFile.readline()
+                name = events[offset:offset + length].rstrip(b'\0').decode()
+                offset += length
 
-        if len(line) > 0:
-            PI_KEY = line
-            print("Key found.\n\n")
+                if name == fileName:
+                    changed = True
+
+        # No inotify, check modification time every second
         else:
-            print("Creating key...\n\n")
-            uid = str(uuid.uuid1())
-            keyFile.writelines(uid)
-            PI_KEY = uid
+            time.sleep(1)
+            modified = os.path.getmtime(path) if os.path.exists(path) else 0
+
+            if modified != lastModified:
+                lastModified = modified
+                changed = True
+
+        if changed:
+            try:
+                meter.reloadConfig(Config.load(path))
+            except (OSError, ValueError, TypeError) as e:
+                print("Cannot reload config: {0}\n".format(e))
+
+# Meters in one process can't share output files or API port
+
+
+def checkMeterConflicts(meters):
+    used = {}
+    conflicts = []
+
+    for meter in meters:
+        config = meter.config
+
+        # Serial port can only be read by one meter, by-id links resolve to the device
+        resources = [("port", os.path.realpath(config.port))]
+
+        if config.aggregateData:
+            resources.append(
+                ("checkpointFile", os.path.abspath(config.checkpointFile)))
+        if config.trace:
+            resources.append(("traceFile", os.path.abspath(config.traceFile)))
+        if config.profile == "cprofile":
+            resources.append(
+                ("profileFile", os.path.abspath(config.profileFile)))
+        if config.localApi:
+            resources.append(("localApiPort", config.localApiPort))
+
+        for resource in resources:
+            if resource in used:
+                conflicts.append(f"{resource[0]} {resource[1]}")
+            used[resource] = meter
+
+    return conflicts
+
+# Setup meter and run main loop
+
+
+def runMeter(meter):
+    if meter.config.aggregateData:
+        meter.loadCheckpoint()
+
+    if meter.config.localApi:
+        meter.startLocalApi()
+
+    meter.profileMainLoop()
 
 
 if __name__ == "__main__":
-    # Setup
-    createUUID()
+    defaultConfigPath = os.environ.get("P1_CONFIG", "config.json")
+
+    # Print summary of trace file: readAndFormat.py --summary [trace.bin]
+    if len(sys.argv) > 1 and sys.argv[1] == "--summary":
+        summarizeTrace(sys.argv[2] if len(
+            sys.argv) > 2 else Config.load(defaultConfigPath).traceFile)
+        sys.exit()
+
+    # One config file per meter: readAndFormat.py [config.json ...]
+    configPaths = sys.argv[1:] or [defaultConfigPath]
+    meters = [P1Meter(Config.load(configPath)) for configPath in configPaths]
+
+    # Stop like Ctrl+C on SIGTERM, so main loops can save their state
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    conflicts = checkMeterConflicts(meters)
+    if conflicts != []:
+        print("Meters can't share:", ", ".join(conflicts))
+        sys.exit(1)
+
+    # Meters can share a key file, create it before the threads start
+    for meter in meters:
+        meter.createUUID()
+
+    for configPath, meter in zip(configPaths, meters):
+        threading.Thread(target=watchConfig, args=(
+            configPath, meter), daemon=True).start()
 
     # Run main loop
-    mainLoop()
+    if len(meters) == 1:
+        runMeter(meters[0])
+    else:
+        threads = [threading.Thread(target=runMeter, args=(meter,), daemon=True)
+                   for meter in meters]
+
+        for thread in threads:
+            thread.start()
+
+        try:
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(1)
+
+        except KeyboardInterrupt:
+            print("CLOSING PROGRAM")
+
+            # Main loops stop after their next line
+            for meter in meters:
+                meter.running = False
+
+            for thread in threads:
+                thread.join()
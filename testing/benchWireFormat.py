@@ -0,0 +1,117 @@
+# Compare upload wire formats against a local mock endpoint
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from datetime import datetime, timedelta
+from contextlib import redirect_stdout
+from tabulate import tabulate
+import threading
+import io
+import time
+import gzip
+import json
+import zlib
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import readAndFormat  # noqa: E402
+
+MOCK_PORT = 8765
+
+# Amount of readings per run, one day at 15 minute interval
+READINGS = 96
+
+# Bytes received by the mock endpoint
+RECEIVED = []
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    # Advertise supported upload formats
+    def do_OPTIONS(self):
+        self.send_response(204)
+        self.send_header('Accept-Encoding', 'gzip, deflate')
+        self.send_header('Accept-Post', 'application/json, ' +
+                         readAndFormat.COLUMNAR_TYPE)
+        self.end_headers()
+
+    # Check that body decodes, store size on the wire
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        RECEIVED.append(len(body))
+
+        encoding = self.headers.get('Content-Encoding', '')
+        if encoding == 'gzip':
+            body = gzip.decompress(body)
+        elif encoding == 'deflate':
+            body = zlib.decompress(body)
+        json.loads(body)
+
+        self.send_response(201)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+# Create readings based on obisExample.txt, counters increase every reading
+
+
+def createReadings():
+    start = datetime(2023, 1, 17, 11, 45, 0)
+    readings = []
+
+    for i in range(READINGS):
+        readings.append({
+            "date":                     str(start + timedelta(minutes=15 * i)),
+            "meterId":                  1,
+            "totalConsumptionDay":      round(3277.086 + 0.017 * i, 3),
+            "totalConsumptionNight":    2582.062,
+            "allPhaseConsumption":      round(0.067 + 0.001 * (i % 7), 3),
+            "gasConsumption":           round(1939.257 + 0.004 * i, 3),
+        })
+
+    return readings
+
+
+def runBench(encoding, batchSize, readings):
+    meter = readAndFormat.P1Meter(readAndFormat.Config(
+        sendUrl=f'http://127.0.0.1:{MOCK_PORT}/api/MeterData',
+        uploadEncoding=encoding, batchSize=batchSize))
+    meter.apiToken = 'Bearer bench'
+    RECEIVED.clear()
+
+    cpuTime = 0.0
+
+    # Hide submit messages
+    with redirect_stdout(io.StringIO()):
+        for dto in readings:
+            cpuStart = time.process_time()
+            meter.pendingData.append(dto)
+
+            if len(meter.pendingData) >= batchSize:
+                meter.flushData()
+            cpuTime += time.process_time() - cpuStart
+
+        cpuStart = time.process_time()
+        meter.flushData()
+        cpuTime += time.process_time() - cpuStart
+
+    return (sum(RECEIVED) / len(readings), cpuTime * 1e6 / len(readings))
+
+
+if __name__ == "__main__":
+    server = HTTPServer(('127.0.0.1', MOCK_PORT), MockHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    readings = createReadings()
+    results = []
+
+    for encoding, batchSize in [("identity", 1), ("gzip", 1), ("deflate", 1),
+                                ("identity", 96), ("gzip", 96), ("deflate", 96)]:
+        bytesPerReading, cpuPerReading = runBench(
+            encoding, batchSize, readings)
+        results.append((encoding, batchSize, round(
+            bytesPerReading, 1), round(cpuPerReading, 1)))
+
+    print(tabulate(results, headers=['Encoding', 'Batch', 'Bytes/reading', 'CPU us/reading'],
+                   tablefmt='pretty'))
+
+    server.shutdown()